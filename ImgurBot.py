@@ -1,13 +1,15 @@
+import atexit
+import contextlib
 import sqlite3
-import datetime
+import stat
+import sys
 import os
-import shutil
-import math
+import threading
+import time
+import weakref
 
-import ConfigParser
-
-from imgurpython import ImgurClient
-from imgurpython.helpers.error import ImgurClientError
+import configparser
+from io import StringIO
 
 # TODO: Implement rate limiting on non-OAuth calls.
 # TODO: Figure out some kind of fail-safe that stops the client cold when ImgurClientRateLimitError is thrown.
@@ -16,12 +18,21 @@ from imgurpython.helpers.error import ImgurClientError
 
 # TODO: Mid-process: Convert log and debug_log statements to unified logs with log levels.
 
-# TODO: Look into making this truly Python 2/3 compatible (currently 2-exclusive with 3 compat thrown in).
-
 
 class ImgurBot:
     """
     A class that implements a bot for interfacing with Imgur.
+
+    Use the bot as a context manager (with ImgurBot(name) as bot: ...) or call close() when finished, so that pending
+    database writes and buffered log lines are reliably written out.
+
+    The Imgur client is created and authenticated the first time the client attribute is accessed, so bots that only
+    use the database or config never make a network round-trip.
+
+    __init__ runs the initializers in order: initialize_logging, then initialize_database, then initialize_config. The
+    per-call methods (mark_seen, has_seen and friends) rely on that order and do not re-check it; in testing mode, call
+    the initializers yourself before using them. log is the exception: it raises RuntimeError before initialize_logging,
+    since it would otherwise buffer lines that are silently dropped.
     """
     version = "0.2a"
 
@@ -29,39 +40,108 @@ class ImgurBot:
     # Space not included since it's safe in these use cases. Other characters are probably safe too, but YMMV.
     # TODO: Figure out if any other characters can be pruned from this list for enhanced user-friendliness.
     restricted_filesystem_chars = "/\\?*%:|\"<>."
-    log_levels = {"Debug": 5, "Information": 4, "Warning": 3, "Error": 2, "Fatal": 1}
-
-    def __init__(self, name="ImgurBot", print_at_log_level="Warning", testing_mode=False):
+    # Deletion table for str.translate, built once.
+    _strip_table = str.maketrans('', '', restricted_filesystem_chars)
+    # Numeric log levels; lower is more severe. log() and print_at_log_level accept either a constant or its name.
+    DEBUG, INFO, WARNING, ERROR, FATAL = 5, 4, 3, 2, 1
+    log_levels = {"Debug": DEBUG, "Information": INFO, "Warning": WARNING, "Error": ERROR, "Fatal": FATAL}
+    _log_level_names = {level: level_name for level_name, level in log_levels.items()}
+
+    # Log lines are held in memory and written out in batches: either once log_flush_threshold lines are pending, or
+    # log_flush_interval seconds after the first pending line was logged, whichever comes first.
+    log_buffer_size = 65536
+    log_flush_threshold = 64
+    log_flush_interval = 0.2
+    # Messages at or above this level (a name or constant) are written out immediately, so they survive a crash that
+    # follows them. Read once, when the bot is created.
+    log_flush_at_level = "Error"
+
+    # SQL for the Seen table write paths. Each is kept as a single constant string so that sqlite3's per-connection
+    # statement cache (keyed on the SQL text) can reuse the compiled statement on every call. Reads are served from
+    # the in-memory copy of the table loaded by initialize_database.
+    _sql_mark_seen = "INSERT INTO Seen(id) VALUES (?)"
+    _sql_mark_seen_many = "INSERT OR IGNORE INTO Seen(id) VALUES (?)"
+    sqlite_cached_statements = 128
+    # Seconds a connection waits for another connection's write lock before failing with "database is locked". Passed
+    # to sqlite3.connect, so it also covers the PRAGMA journal_mode=WAL switch that runs right after connecting.
+    sqlite_busy_timeout = 5.0
+    # Bytes of the database file SQLite may access through mmap. Set to 0 to disable memory-mapped I/O, which can be
+    # unreliable on network filesystems and counts against the process's address space.
+    sqlite_mmap_size = 268435456
+
+    # mark_seen does not commit on every call; pending inserts are committed once this many have accumulated, at most
+    # seen_commit_interval seconds after the first of them, or on flush() / deconstruction. The interval bounds how long
+    # a bot holds SQLite's write lock, which blocks every other connection (e.g. another bot with the same name).
+    seen_commit_threshold = 500
+    seen_commit_interval = 1.0
+
+    # Parsed .ini contents shared by every bot in this process: {ini_path: (mtime, {section: [(option, value), ...]})}.
+    _ini_cache = {}
+
+    # Access and refresh tokens already verified against Imgur in this process:
+    # {ini_path: (access_token, refresh_token)}.
+    # Lets later bots using the same .ini skip the verification round-trip and the interactive PIN workflow.
+    _verified_auth = {}
+
+    # Bots that have not been closed yet; closed by _close_open_bots at interpreter exit.
+    _open_bots = weakref.WeakSet()
+
+    def __init__(self, name="ImgurBot", print_at_log_level="Warning", testing_mode=False, echo_stdout=True):
         """Initialize the ImgurBot.
 
         :type name: str
+        :param echo_stdout: False to only write log messages to the logfile, regardless of print_at_log_level.
+        :type echo_stdout: bool
 
         This constructor has a testing_mode option which sets the name and then exits. This is designed to enable unit
         testing of other initialization measures (database, config). Please make sure you understand the flow of the
-        program and what must be initialized in what order before you invoke this option; limited protection against
-        out-of-order initialization has been added, but they are by no means comprehensive.
+        program and what must be initialized in what order before you invoke this option: the initializers and a few
+        one-off methods (reset_seen, get_new_auth_info) check their prerequisites, but the per-call methods (mark_seen,
+        has_seen and friends) do not, and fail with unrelated errors if called before initialize_database. log raises
+        RuntimeError before initialize_logging.
         """
 
         # Table of instance variables: These are pre-defined here so that the initialize_x() methods can be used to
         #    init the bot without loss of readability.
 
         # TODO: Comments.
+        self.cwd = os.getcwd()
         self.log_path = None
         self.db_path = None
         self.ini_path = None
 
         self.db = None
+        self.seen = None
+        self._seen_cursor = None
+        self._uncommitted_seen = 0
+        self._seen_lock = threading.RLock()  # Serializes the Seen write paths with the timed commit.
+        self._seen_timer = None
+        self._batch_depth = 0  # Number of open batch_seen blocks; only changes while _seen_lock is held.
         self.logfile = None
         self.config = None
-
-        self.client = None
+        self._config_dirty = False  # True when self.config holds changes that have not been written to ini_path.
+
+        self._log_buffer = []
+        self._log_lock = threading.Lock()
+        self._log_timer = None
+        self._log_timestamp_second = None
+        self._log_timestamp = None
+        # Resolved once here rather than on every log() call, like _print_threshold.
+        flush_at_level = ImgurBot.log_flush_at_level
+        self._flush_level = (flush_at_level if isinstance(flush_at_level, int)
+                             else ImgurBot.log_levels[flush_at_level])
+
+        self._client = None
         self.testing_mode = testing_mode
+        self.echo_stdout = echo_stdout
+        self.closed = False
+        ImgurBot._open_bots.add(self)
 
         # Set the bot's name (defaults to ImgurBot). Remove restricted filesystem characters while we're at it.
-        self.name = name.translate(None, ImgurBot.restricted_filesystem_chars)
+        self.name = name.translate(ImgurBot._strip_table)
 
         # Set the bot's log level (defaults to Warning).
-        if print_at_log_level not in ImgurBot.log_levels:
+        if print_at_log_level not in ImgurBot.log_levels and print_at_log_level not in ImgurBot._log_level_names:
             print("Log level {0} is not a valid log level. Defaulting to 'Warning'.".format(str(print_at_log_level)))
             self.print_at_log_level = "Warning"
         else:
@@ -86,26 +166,114 @@ class ImgurBot:
         # Set up the ConfigParser and load from ini/NAME.ini.
         self.initialize_config()
 
-        # Initialize the client and perform authentication.
-        self.initialize_client()
+        # The client is initialized and authenticated on first access of self.client.
         self.log("Initialization of bot '{0}' complete.".format(self.name), "Debug")
 
-    def __del__(self):
-        """Deconstruct the ImgurBot."""
+    @property
+    def print_at_log_level(self):
+        """The name of the least severe log level that log() also echoes to stdout. May be set by name or constant."""
+        return self._print_at_log_level
+
+    @print_at_log_level.setter
+    def print_at_log_level(self, log_level):
+        # Resolved once here rather than on every log() call.
+        if isinstance(log_level, int):
+            self._print_at_log_level = ImgurBot._log_level_names[log_level]
+            self._print_threshold = log_level
+        else:
+            self._print_at_log_level = log_level
+            self._print_threshold = ImgurBot.log_levels[log_level]
 
-        # Record our most up-to-date auth token.
-        if self.config is not None and self.client is not None and self.client.auth is not None:
-            self.config.set('credentials', 'access_token', self.client.auth.get_current_access_token())
-            self.write_ini_file()
+    @property
+    def client(self):
+        """The ImgurClient for this bot, created and authenticated by initialize_client on first access."""
+        if self._client is None:
+            self.initialize_client()
+        return self._client
 
-        # Clean up the SQLite database. Note: This does not perform a commit.
-        if self.db is not None:
-            self.db.close()
+    def __enter__(self):
+        return self
 
-        # Close the logfile.
-        if self.logfile is not None:
-            self.log("Successful termination of ImgurBot.", "Debug")
-            self.logfile.close()
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def __del__(self):
+        """Safety net for bots that were not closed explicitly. Prefer close() or a with-block: finalizers run at an
+        unpredictable time, possibly during interpreter shutdown when the modules close() relies on are gone."""
+        # noinspection PyBroadException
+        try:
+            if not self.closed:
+                if self.logfile is not None:
+                    self.log("ImgurBot '{0}' was not closed before being garbage collected; use close() or a "
+                             "with-block.".format(self.name), "Warning")
+                self.close()
+        except Exception:
+            pass
+
+    def close(self):
+        """Deconstruct the ImgurBot: commit pending database writes, record the current auth token, and flush and close
+        the logfile. Calling close() more than once has no further effect.
+
+        Raises RuntimeError inside a batch_seen block: the block holds _seen_lock, which a timed commit may already be
+        waiting on, so close() could not wait for that timer to exit."""
+        if self.closed:
+            return
+        with self._seen_lock:
+            # With the lock held, an open batch can only belong to this thread.
+            if self._batch_depth:
+                raise RuntimeError("close() cannot be called inside a batch_seen block.")
+        self.closed = True
+        ImgurBot._open_bots.discard(self)
+
+        # Each stage runs even if an earlier one raised: pending database writes are committed first, since they are
+        # the hardest to recover, and the logfile stays open until last so that the later stages can still log.
+        try:
+            try:
+                # Commit any pending mark_seen calls, then clean up the SQLite database.
+                if self.db is not None:
+                    timer = self._seen_timer
+                    try:
+                        self.commit_seen()
+                    finally:
+                        if timer is not None and timer is not threading.current_thread():
+                            timer.join()  # Cancelled by commit_seen; wait for the thread to exit.
+                        with self._seen_lock:
+                            if self._seen_cursor is not None:
+                                self._seen_cursor.close()
+                            self.db.close()
+                            self.db = None
+            finally:
+                # Record our most up-to-date auth token.
+                # Check the private attribute so that closing never triggers client initialization.
+                if self.config is not None and self._client is not None and self._client.auth is not None:
+                    access_token = self._client.auth.get_current_access_token()
+                    self._set_credential('access_token', access_token)
+                    if self.ini_path in ImgurBot._verified_auth:
+                        ImgurBot._verified_auth[self.ini_path] = (access_token,
+                                                                  ImgurBot._verified_auth[self.ini_path][1])
+                    if self._config_dirty:
+                        self.write_ini_file()
+        finally:
+            # Drain any buffered log lines, then close the logfile.
+            if self.logfile is not None:
+                self.log("Successful termination of ImgurBot.", "Debug")
+                timer = self._log_timer
+                self.flush_log()
+                if timer is not None and timer is not threading.current_thread():
+                    timer.join()  # Cancelled by flush_log; wait for the thread to exit.
+                self.logfile.close()
+                self.logfile = None
+
+    @staticmethod
+    def _close_open_bots():
+        """Closes every bot that is still open. Registered with atexit, which runs while modules are still intact, so
+        that bots left for the finalizer still commit their pending writes."""
+        for bot in list(ImgurBot._open_bots):
+            # One bot failing to close must not leave the remaining bots unclosed and uncommitted.
+            try:
+                bot.close()
+            except Exception as e:
+                print("Error closing ImgurBot '{0}' at exit: {1}: {2}.".format(bot.name, str(e), str(e.args)))
 
     # External / Imgur-facing methods
     def get_new_auth_info(self, no_file_write=False):
@@ -113,7 +281,9 @@ class ImgurBot:
         """
         # No access or refresh tokens. Send them to the auth workflow.
         assert self.config is not None, "Out-of-order call: initialize_config must be called before get_new_auth_info."
-        assert self.client is not None, "Out-of-order call: initialize_client must be called before get_new_auth_info."
+        assert self._client is not None, "Out-of-order call: initialize_client must be called before get_new_auth_info."
+
+        from imgurpython.helpers.error import ImgurClientError
 
         print("")
         print("You need to supply your PIN to obtain access and refresh tokens.")
@@ -124,21 +294,20 @@ class ImgurBot:
         # Loop and obtain the correct PIN.
         while True:
             try:
-                pin = self.get_input("Enter the PIN code from the above URL: ")
+                pin = input("Enter the PIN code from the above URL: ")
                 credentials = self.client.authorize(pin, 'pin')
                 print("")
                 break
             except ImgurClientError as e:
-                if str(e) == "(400) Invalid Pin":
+                if e.status_code == 400 and e.error_message == "Invalid Pin":
                     print("\nYou have entered an invalid pin. Try again.")
-                elif str(e) == "(400) The client credentials are invalid":
+                elif e.status_code == 400 and e.error_message == "The client credentials are invalid":
                     # offer choice: delete credentials and recreate?
-                    result = self.get_input("Your client credentials were incorrect. " +
-                                            "Would you like to go through interactive bot registration? (y/N): ")
+                    result = input("Your client credentials were incorrect. " +
+                                   "Would you like to go through interactive bot registration? (y/N): ")
                     if result == 'y':
                         self.log("Moving {0} to {0}.old.".format(self.ini_path), "Information")
-                        shutil.copy(self.ini_path, "{0}.old".format(self.ini_path))
-                        os.remove(self.ini_path)
+                        os.replace(self.ini_path, "{0}.old".format(self.ini_path))
                         self.initialize_config()
                         self.initialize_client()
                         return
@@ -149,9 +318,9 @@ class ImgurBot:
 
         self.log("Access and refresh token successfully obtained.", "Debug")
         # noinspection PyTypeChecker
-        self.config.set('credentials', 'access_token', credentials['access_token'])
+        self._set_credential('access_token', credentials['access_token'])
         # noinspection PyTypeChecker
-        self.config.set('credentials', 'refresh_token', credentials['refresh_token'])
+        self._set_credential('refresh_token', credentials['refresh_token'])
 
         if no_file_write:
             return
@@ -161,41 +330,220 @@ class ImgurBot:
     # Internal / non Imgur-facing methods
     def log(self, message, log_level):
         """Writes the given message to NAME.log, prefixed with current date and time. Ends with a newline.
-        Also prints the message to the screen.
+        Also prints the message to the screen if echo_stdout is set and log_level is at or above print_at_log_level.
 
-        :param log_level: A string to indicate the level of the log message.
+        :param log_level: The level of the log message: one of the constants ImgurBot.DEBUG through ImgurBot.FATAL, or
+        its name in log_levels. The constants skip the name lookup.
         :type message: str
-        :type log_level: str
+        :type log_level: int | str
         """
-        assert self.logfile is not None, "Out-of-order call: initialize_logging must be called before log."
-
-        self.logfile.write("[{0}-{1}]: ".format(datetime.datetime.now().strftime("%c"), log_level) + message + '\n')
-        if ImgurBot.log_levels[log_level] <= ImgurBot.log_levels[self.print_at_log_level]:
-            print(message)
+        # Raised rather than asserted: without a logfile, buffered lines would be silently dropped, even under -O.
+        if self.logfile is None:
+            raise RuntimeError("Out-of-order call: initialize_logging must be called before log.")
+
+        # %c has one-second resolution, so only reformat the timestamp when the second changes.
+        second = int(time.time())
+        if second != self._log_timestamp_second:
+            self._log_timestamp = time.strftime("%c", time.localtime(second))
+            self._log_timestamp_second = second
+
+        if isinstance(log_level, int):
+            level = log_level
+            log_level = ImgurBot._log_level_names[level]
+        else:
+            level = ImgurBot.log_levels[log_level]
+        line = "[{0}-{1}]: {2}\n".format(self._log_timestamp, log_level, message)
+        with self._log_lock:
+            self._log_buffer.append(line)
+            if len(self._log_buffer) >= ImgurBot.log_flush_threshold or level <= self._flush_level:
+                self._write_log_buffer()
+            elif self._log_timer is None:
+                # First pending line: make sure it reaches the disk within log_flush_interval seconds. The timer only
+                # holds a weak reference so that a pending flush never keeps the bot alive.
+                self._log_timer = threading.Timer(ImgurBot.log_flush_interval, ImgurBot._timed_flush_log,
+                                                  [weakref.ref(self)])
+                self._log_timer.daemon = True
+                self._log_timer.start()
+
+        if self.echo_stdout and level <= self._print_threshold:
+            sys.stdout.write(message + '\n')
+
+    def flush_log(self):
+        """Writes all buffered log lines out to NAME.log."""
+        with self._log_lock:
+            self._write_log_buffer()
 
-    def mark_seen(self, post_id):
+    @staticmethod
+    def _timed_flush_log(bot_ref):
+        """Timer callback for flush_log. Does nothing if the bot has already been deconstructed."""
+        bot = bot_ref()
+        if bot is not None:
+            bot.flush_log()
+
+    def _write_log_buffer(self):
+        """Writes the log buffer to the logfile in a single write. The caller must hold _log_lock."""
+        if self._log_timer is not None:
+            self._log_timer.cancel()
+            self._log_timer = None
+
+        if self._log_buffer and self.logfile is not None:
+            # One write of the joined batch, so the text layer encodes it once rather than once per line.
+            self.logfile.write(''.join(self._log_buffer))
+            self.logfile.flush()
+        del self._log_buffer[:]
+
+    def mark_seen(self, post_id, commit=False):
         """Marks a post identified by post_id as seen.
 
-        Possible exception: sqlite.IntegrityError if the post was already marked as seen.
+        Unless commit is set, the insert is not committed immediately; pending inserts are committed in a single
+        transaction once seen_commit_threshold of them have accumulated, seen_commit_interval seconds after the first
+        of them, or when flush() is called or the bot is deconstructed. Inside a batch_seen block, the threshold and
+        interval commits wait for the block to exit.
+
+        Possible exceptions: sqlite.IntegrityError if the post was already marked as seen; TypeError if post_id is not
+        a str, as for mark_seen_many.
 
+        :param commit: True to commit this (and any other pending) insert before returning.
         :type post_id: str
+        :type commit: bool
         """
-        assert self.db is not None, "Out-of-order call: initialize_database must be called before mark_seen."
+        ImgurBot._check_post_id(post_id)
+        with self._seen_lock:
+            self._begin_seen_transaction()
+            try:
+                self._seen_cursor.execute(ImgurBot._sql_mark_seen, (post_id,))
+                self.seen.add(post_id)
+                self._uncommitted_seen += 1
+                if commit or (self._uncommitted_seen >= ImgurBot.seen_commit_threshold and not self._batch_depth):
+                    self.commit_seen()
+            finally:
+                # Even if the insert failed, an open transaction must not hold the write lock indefinitely.
+                self._arm_seen_timer()
+
+    def mark_seen_many(self, post_ids):
+        """Marks every post identified in post_ids as seen, using a single statement and a single commit. Inside a
+        batch_seen block, the commit is left to the block. Unlike mark_seen, posts that were already marked as seen are
+        silently skipped.
+
+        Possible exception: TypeError if any id is not a str, checked before anything is written.
+
+        :type post_ids: collections.Iterable[str]
+        """
+        post_ids = list(post_ids)
+        for post_id in post_ids:
+            ImgurBot._check_post_id(post_id)
+        with self._seen_lock:
+            self._begin_seen_transaction()
 
-        self.db.execute("INSERT INTO Seen(id) VALUES (?)", [post_id])
-        self.db.commit()
+            try:
+                # The savepoint lets a failed batch be undone without discarding earlier, still-uncommitted mark_seen
+                # calls.
+                self.db.execute("SAVEPOINT mark_seen_many")
+                try:
+                    self._seen_cursor.executemany(ImgurBot._sql_mark_seen_many, ((post_id,) for post_id in post_ids))
+                except sqlite3.Error:
+                    self.db.execute("ROLLBACK TO mark_seen_many")
+                    self.db.execute("RELEASE mark_seen_many")
+                    raise
+                self.db.execute("RELEASE mark_seen_many")
+
+                self.seen.update(post_ids)
+                if not self._batch_depth:
+                    self.commit_seen()
+            finally:
+                # As in mark_seen: if the batch failed, the transaction it opened must still be committed in time.
+                self._arm_seen_timer()
+
+    @staticmethod
+    def _check_post_id(post_id):
+        """Raises TypeError unless post_id is a str. The Seen column stores ids as text while the in-memory copy keeps
+        the caller's object, so any other type would leave the two disagreeing: 1 would be stored as '1' yet only match
+        has_seen(1) until a reopen, and INSERT OR IGNORE would silently skip None while has_seen(None) answered True."""
+        if not isinstance(post_id, str):
+            raise TypeError("Post ids must be str, not {0}: {1!r}.".format(type(post_id).__name__, post_id))
+
+    def commit_seen(self):
+        """Commits any mark_seen calls that have not yet been committed to the database."""
+        with self._seen_lock:
+            if self._seen_timer is not None:
+                self._seen_timer.cancel()
+                self._seen_timer = None
+            if self.db.in_transaction:
+                self.db.execute("COMMIT")
+            self._uncommitted_seen = 0
+
+    @staticmethod
+    def _timed_commit_seen(bot_ref):
+        """Timer callback for commit_seen. Does nothing if the bot has already been closed or deconstructed."""
+        bot = bot_ref()
+        if bot is not None:
+            with bot._seen_lock:
+                if bot.db is not None:
+                    bot.commit_seen()
+
+    def _arm_seen_timer(self):
+        """Starts the timed commit if a write transaction is open and none is pending, so that the transaction holds
+        the write lock for at most seen_commit_interval seconds. Callers hold _seen_lock."""
+        if self.db.in_transaction and self._seen_timer is None:
+            # The timer only holds a weak reference so that a pending commit never keeps the bot alive.
+            self._seen_timer = threading.Timer(ImgurBot.seen_commit_interval, ImgurBot._timed_commit_seen,
+                                               [weakref.ref(self)])
+            self._seen_timer.daemon = True
+            self._seen_timer.start()
+
+    def _begin_seen_transaction(self):
+        """Opens the write transaction that pending mark_seen calls accumulate in, unless one is already open.
+
+        The connection runs in autocommit mode (isolation_level=None), so every transaction is started and ended
+        explicitly here and in commit_seen rather than implicitly by the sqlite3 module. Callers hold _seen_lock.
+        """
+        if not self.db.in_transaction:
+            self.db.execute("BEGIN IMMEDIATE")
+
+    @contextlib.contextmanager
+    def batch_seen(self):
+        """Context manager that groups the mark_seen calls made inside the with-block into one transaction, committed
+        when the block exits (normally or through an exception, so that the database stays in step with has_seen).
+        The threshold and timed commits wait for the block to exit; an explicit commit (mark_seen with commit set,
+        commit_seen or flush) still commits the calls made so far, and the rest of the block continues in a new
+        transaction."""
+        with self._seen_lock:
+            self._begin_seen_transaction()
+            self._batch_depth += 1
+            try:
+                yield self
+            finally:
+                self._batch_depth -= 1
+                self.commit_seen()
+
+    def flush(self):
+        """Commits pending mark_seen calls and writes out buffered log lines."""
+        if self.db is not None:
+            self.commit_seen()
+        if self.logfile is not None:
+            self.flush_log()
 
     def has_seen(self, post_id):
-        """Boolean check for if the bot has seen the post identified by post_id.
+        """Boolean check for if the bot has seen the post identified by post_id. Answered from the in-memory copy of the
+        Seen table, so this never touches the database: it reflects the table as loaded by initialize_database plus
+        this bot's own writes since, not rows written through other connections (e.g. another bot with the same name).
         :type post_id: str
 
-        :return: True if post_id in DB, false otherwise.
+        :return: True if post_id is in the in-memory copy of the Seen table, false otherwise.
         """
-        assert self.db is not None, "Out-of-order call: initialize_database must be called before has_seen."
+        return post_id in self.seen
+
+    def has_seen_many(self, post_ids):
+        """Batch form of has_seen: checks every post identified in post_ids at once.
+        :type post_ids: collections.Iterable[str]
 
-        cursor = self.db.cursor()
-        cursor.execute("SELECT * FROM Seen WHERE id = ?", [post_id])
-        return cursor.fetchone() is not None
+        :return: The set of ids from post_ids that the bot has seen. Like has_seen, only reflects this bot's writes.
+        """
+        return self.seen.intersection(post_ids)
+
+    def __contains__(self, post_id):
+        """Membership form of has_seen, so that callers can write 'if post_id in bot'."""
+        return self.has_seen(post_id)
 
     def reset_seen(self, force=False):
         """ Delete all entries from 'Seen' table in the database. Due to the extremely destructive nature of this
@@ -208,21 +556,52 @@ class ImgurBot:
         assert self.db is not None, "Out-of-order call: initialize_database must be called before reset_seen."
 
         if not force:
-            response = self.get_input("Are you sure you want to delete all entries from the Seen table? (y/N): ")
+            response = input("Are you sure you want to delete all entries from the Seen table? (y/N): ")
             if response != 'y':
                 print("Canceling reset_seen.")
                 return
 
         self.log("Deleting all entries from 'Seen' table.", "Debug")
-        self.db.execute("DELETE FROM Seen")
-        self.db.commit()
+        with self._seen_lock:
+            self._begin_seen_transaction()
+            self.db.execute("DELETE FROM Seen")
+            self.seen.clear()
+            self.commit_seen()
+
+    def _set_credential(self, option, value):
+        """Sets an option in the credentials section, marking the config dirty only if the value actually changed."""
+        if not (self.config.has_option('credentials', option) and self.config.get('credentials', option) == value):
+            self.config.set('credentials', option, value)
+            self._config_dirty = True
 
     def write_ini_file(self):
         self.log("Writing config file at {0}.".format(self.ini_path), "Debug")
+        ImgurBot._ini_cache.pop(self.ini_path, None)
+        tmp_path = "{0}.tmp".format(self.ini_path)
         try:
-            with open(self.ini_path, 'w') as ini_file:
-                self.config.write(ini_file)
-        except IOError as e:
+            # Serialize in memory first so that the file receives the whole config in a single write, then swap it into
+            # place; a crash mid-write leaves the previous config intact instead of a truncated one.
+            buf = StringIO()
+            self.config.write(buf)
+            # The file holds the client secret and tokens: the temporary file is created owner-only, then given the
+            # existing file's mode so that the swap does not change who can read the config.
+            try:
+                mode = stat.S_IMODE(os.stat(self.ini_path).st_mode)
+            except FileNotFoundError:
+                mode = 0o600
+            with open(os.open(tmp_path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600), 'w') as ini_file:
+                ini_file.write(buf.getvalue())
+                ini_file.flush()
+                os.fsync(ini_file.fileno())
+            os.chmod(tmp_path, mode)
+            os.replace(tmp_path, self.ini_path)
+            self._config_dirty = False
+        except OSError as e:
+            # Do not leave a stray copy of the secrets behind.
+            try:
+                os.remove(tmp_path)
+            except OSError:
+                pass
             self.log("Error when writing config file at {0}: {1}: {2}\n".format(self.ini_path, str(e), str(e.args)) +
                      "Please manually create the file with the following contents: \n" +
                      "\n" +
@@ -239,40 +618,78 @@ class ImgurBot:
         log_path and logfile variables."""
 
         # Broken out from __init__ to aid in testing.
-        log_dir = ImgurBot.ensure_dir_in_cwd_exists("log")
+        log_dir = ImgurBot.ensure_dir_in_cwd_exists("log", self.cwd)
         self.log_path = os.path.join(log_dir, "{0}.log".format(self.name))
 
-        self.logfile = open(self.log_path, 'a')
+        self.logfile = open(self.log_path, 'a', ImgurBot.log_buffer_size)
 
     def initialize_database(self):
-        db_dir = ImgurBot.ensure_dir_in_cwd_exists("db")
+        db_dir = ImgurBot.ensure_dir_in_cwd_exists("db", self.cwd)
         self.db_path = os.path.join(db_dir, "{0}.db".format(self.name))
 
         try:
-            # Inform the user that a new .db file is being created (if not previously extant).
-            if not os.path.isfile(self.db_path):
-                self.log("Creating database at {0}.".format(self.db_path), "Debug")
-
             # Connect and ensure that the database is set up properly.
-            self.db = sqlite3.connect(self.db_path)
-            cursor = self.db.cursor()
-            cursor.execute("CREATE TABLE IF NOT EXISTS Seen(id TEXT PRIMARY KEY NOT NULL)")
+            # check_same_thread is off because the timed commit runs on its own thread; _seen_lock serializes it.
+            self.db = sqlite3.connect(self.db_path, timeout=ImgurBot.sqlite_busy_timeout, isolation_level=None,
+                                      check_same_thread=False, cached_statements=ImgurBot.sqlite_cached_statements)
+
+            # WAL journaling with synchronous=NORMAL turns each commit into an append to the WAL file rather than a
+            # synced rewrite of the rollback journal, and lets readers proceed while a write is in progress.
+            # Some filesystems cannot host a WAL file; SQLite then keeps the old journal mode, so check what we got.
+            journal_mode = self.db.execute("PRAGMA journal_mode=WAL").fetchone()[0]
+            if journal_mode.lower() != "wal":
+                self.log("Could not enable WAL journaling on {0}; using '{1}'.".format(self.db_path, journal_mode),
+                         "Warning")
+            self.db.executescript("PRAGMA synchronous=NORMAL;"
+                                  "PRAGMA temp_store=MEMORY;"
+                                  "PRAGMA cache_size=-20000;"
+                                  "PRAGMA mmap_size={0:d};".format(ImgurBot.sqlite_mmap_size))
+
+            # Seen is a pure existence set keyed on the post id, so store it WITHOUT ROWID: the table is then a single
+            # B-tree keyed on id rather than a rowid table plus a separate primary key index. The schema lookup doubles
+            # as the new-database check, so no separate stat of the .db file is needed.
+            row = self.db.execute("SELECT sql FROM sqlite_master WHERE type = 'table' AND name = 'Seen'").fetchone()
+            if row is None:
+                self.log("Creating database at {0}.".format(self.db_path), "Debug")
+                self.db.execute("CREATE TABLE Seen(id TEXT PRIMARY KEY NOT NULL) WITHOUT ROWID")
+            elif "WITHOUT ROWID" not in row[0].upper():
+                # One-time migration of databases created by earlier versions.
+                self.log("Migrating 'Seen' table in {0} to WITHOUT ROWID storage.".format(self.db_path), "Information")
+                self.db.executescript("BEGIN;"
+                                      "CREATE TABLE Seen_new(id TEXT PRIMARY KEY NOT NULL) WITHOUT ROWID;"
+                                      "INSERT INTO Seen_new(id) SELECT id FROM Seen;"
+                                      "DROP TABLE Seen;"
+                                      "ALTER TABLE Seen_new RENAME TO Seen;"
+                                      "COMMIT;")
+
+            # Load the Seen table into memory once so that has_seen is a set lookup rather than a query.
+            self.seen = set(row[0] for row in self.db.execute("SELECT id FROM Seen"))
+
+            # A single long-lived cursor for the Seen write paths, rather than a new implicit one per statement.
+            self._seen_cursor = self.db.cursor()
 
         except sqlite3.Error as e:
             self.log("Error in DB setup: {0}: {1}.".format(str(e), str(e.args)), "Error")
             if self.db:
                 self.db.close()
+                self.db = None
             raise
 
     def initialize_config(self):
-        ini_dir = ImgurBot.ensure_dir_in_cwd_exists("ini")
+        ini_dir = ImgurBot.ensure_dir_in_cwd_exists("ini", self.cwd)
         self.ini_path = os.path.join(ini_dir, "{0}.ini".format(self.name))
 
         # Generate our config parser.
-        self.config = self.get_raw_config_parser()
+        self.config = configparser.RawConfigParser()
+
+        # Test if config file exists; the same stat supplies the mtime for the parse cache below. If not, create a
+        # template .ini file and terminate.
+        try:
+            mtime = os.path.getmtime(self.ini_path)
+        except OSError:
+            mtime = None
 
-        # Test if config file exists. If not, create a template .ini file and terminate.
-        if not os.path.isfile(self.ini_path):
+        if mtime is None:
             self.config.add_section('credentials')
 
             self.log("No .ini file was found. Beginning interactive creation.", "Debug")
@@ -282,22 +699,22 @@ class ImgurBot:
             print("")
 
             while True:
-                client_id = self.get_input("Enter your client_id: ")
-                client_secret = self.get_input("Enter your client_secret: ")
+                client_id = input("Enter your client_id: ")
+                client_secret = input("Enter your client_secret: ")
                 print("")
-                reply = self.get_input("You entered client_id {0} and _secret {1}".format(client_id, client_secret) +
-                                       ". Are these correct? (y/N): ")
+                reply = input("You entered client_id {0} and _secret {1}".format(client_id, client_secret) +
+                              ". Are these correct? (y/N): ")
                 if reply == "y":
                     self.config.set('credentials', 'client_id', client_id)
                     self.config.set('credentials', 'client_secret', client_secret)
                     break
 
-            reply = self.get_input("Do you have an access and refresh token available? (y/N): ")
+            reply = input("Do you have an access and refresh token available? (y/N): ")
             if reply == "y":
                 while True:
-                    access_token = self.get_input("Enter your access token: ")
-                    refresh_token = self.get_input("Enter your refresh token: ")
-                    reply = self.get_input(
+                    access_token = input("Enter your access token: ")
+                    refresh_token = input("Enter your refresh token: ")
+                    reply = input(
                         "You entered access token {0} and refresh token {1}".format(access_token, refresh_token) +
                         ". Are these correct? (y/N): ")
                     if reply == "y":
@@ -306,98 +723,113 @@ class ImgurBot:
                         break
 
             self.write_ini_file()
-
-        # Point our config parser at the ini file.
-        self.config.read(self.ini_path)
+            mtime = os.path.getmtime(self.ini_path)
+
+        # Point our config parser at the ini file. If another bot in this process already parsed it and it has not been
+        # modified since, reuse that parse instead.
+        cached = ImgurBot._ini_cache.get(self.ini_path)
+        if cached is not None and cached[0] == mtime:
+            for section, options in cached[1].items():
+                if not self.config.has_section(section):
+                    self.config.add_section(section)
+                for option, value in options:
+                    self.config.set(section, option, value)
+        else:
+            self.config.read(self.ini_path)
+            ImgurBot._ini_cache[self.ini_path] = (mtime, dict((section, self.config.items(section))
+                                                              for section in self.config.sections()))
 
     def initialize_client(self):
         assert self.config is not None, "Out-of-order initialization: initialize_config must precede initialize_client."
 
+        # imgurpython (and the requests stack beneath it) is imported here rather than at module level, so that bots
+        # and tools that never talk to Imgur do not pay its import time.
+        from imgurpython import ImgurClient
+        from imgurpython.helpers.error import ImgurClientError
+
+        # Read the whole credentials section in one pass rather than looking each option up individually.
         try:
-            self.client = ImgurClient(self.config.get('credentials', 'client_id'),
-                                      self.config.get('credentials', 'client_secret'))
-        except (ConfigParser.NoOptionError, ConfigParser.NoSectionError) as e:
+            credentials = dict(self.config.items('credentials'))
+            for option in ('client_id', 'client_secret'):
+                if option not in credentials:
+                    raise configparser.NoOptionError(option, 'credentials')
+        except (configparser.NoOptionError, configparser.NoSectionError) as e:
             self.log("Error when parsing config from {0}: {1}: {2}.".format(self.ini_path, str(e), str(e.args)),
                      "Error")
             raise
 
-        # Auth verification loop.
-        while True:
-            # Check to make sure we have access and refresh tokens; if not, have the user go through token creation.
-            if not (self.config.has_option('credentials', 'access_token') and
-                    self.config.has_option('credentials', 'refresh_token')):
-                        self.get_new_auth_info()  # Automatically checks client credential validity.
+        self._client = ImgurClient(credentials['client_id'], credentials['client_secret'])
 
-            # Use the access and refresh tokens read from the file / imported through account authorization.
-            self.client.set_user_auth(self.config.get('credentials', 'access_token'),
-                                      self.config.get('credentials', 'refresh_token'))
-
-            # Verify that the access/refresh tokens we were supplied with are valid.
-            try:
-                self.client.get_account('me')
-            except ImgurClientError as e:
-                if str(e) == "(400) Error refreshing access token!":
-                    self.log("The supplied access and refresh tokens were invalid.", "Error")
-                    self.config.remove_option('credentials', 'access_token')
-                    self.config.remove_option('credentials', 'refresh_token')
-            else:
-                break
-
-    # Static helper methods.
-    @staticmethod
-    def get_input(string):
-        """ Get input from console regardless of python 2 or 3
-        From ImgurPython's examples/helpers.py file. Imported to enable 2.x and 3.x Python compatibility.
-
-        :type string: str
-        :return: The user's inputted string.
-        """
-        # noinspection PyBroadException
+        # get_new_auth_info works through self._client, so it is set during the loop, but it is only kept once
+        # authentication succeeds; otherwise the next access of self.client would return an unauthenticated client.
         try:
-            return raw_input(string)
-        except:
-            return input(string)
+            # Auth verification loop.
+            while True:
+                # Check to make sure we have access and refresh tokens. If not, reuse ones verified earlier in this
+                # process, or failing that have the user go through token creation.
+                if not ('access_token' in credentials and 'refresh_token' in credentials):
+                    if self.ini_path in ImgurBot._verified_auth:
+                        access_token, refresh_token = ImgurBot._verified_auth[self.ini_path]
+                        self._set_credential('access_token', access_token)
+                        self._set_credential('refresh_token', refresh_token)
+                    else:
+                        self.get_new_auth_info()  # Automatically checks client credential validity.
+                    credentials = dict(self.config.items('credentials'))
 
-    @staticmethod
-    def get_raw_config_parser():
-        """ Create a config parser for reading INI files
-        From ImgurPython's examples/helpers.py file. Imported to enable 2.x and 3.x Python compatibility.
-        Modified to return a RawConfigParser to enable remove_option.
+                # Use the access and refresh tokens read from the file / imported through account authorization.
+                tokens = (credentials['access_token'], credentials['refresh_token'])
+                self.client.set_user_auth(*tokens)
 
-        :return: The output of ConfigParser.ConfigParser() or configparser.ConfigParser() depending on Python version.
-        """
-        # noinspection PyBroadException
-        try:
-            # noinspection PyUnresolvedReferences
-            import ConfigParser
-            return ConfigParser.RawConfigParser()
-        except:
-            # noinspection PyUnresolvedReferences
-            import configparser
-            return configparser.RawConfigParser()
+                # Tokens already verified earlier in this process need no further round-trip.
+                if ImgurBot._verified_auth.get(self.ini_path) == tokens:
+                    break
+
+                # Verify that the access/refresh tokens we were supplied with are valid.
+                try:
+                    self.client.get_account('me')
+                except ImgurClientError as e:
+                    if e.status_code == 400 and e.error_message == "Error refreshing access token!":
+                        self.log("The supplied access and refresh tokens were invalid.", "Error")
+                        self.config.remove_option('credentials', 'access_token')
+                        self.config.remove_option('credentials', 'refresh_token')
+                        del credentials['access_token']
+                        del credentials['refresh_token']
+                        ImgurBot._verified_auth.pop(self.ini_path, None)
+                else:
+                    ImgurBot._verified_auth[self.ini_path] = tokens
+                    break
+        except BaseException:
+            self._client = None
+            raise
 
+    # Static helper methods.
     @staticmethod
-    def ensure_dir_in_cwd_exists(directory):
+    def ensure_dir_in_cwd_exists(directory, cwd=None):
         """ Guarantees that the given directory exists by creating it if not extant.
         Note that this removes all slashes and other filesystem-used characters from the passed-in directory parameter,
         and as such will only ever create directories in the current working directory.
 
         :param directory: str
+        :param cwd: The current working directory, if already known. Looked up with os.getcwd() otherwise.
         :return: The full OS-normalized path to the directory with no trailing slash.
         """
 
         # TODO: Is stripping out sensitive characters the best way to handle it, or should we assume the user knows
         # ..... what they're doing?
 
-        path = os.path.join(os.getcwd(), directory.translate(None, ImgurBot.restricted_filesystem_chars))
-        if not os.path.exists(path):
+        if cwd is None:
+            cwd = os.getcwd()
+
+        path = os.path.join(cwd, directory.translate(ImgurBot._strip_table))
+        # One stat in the common case where the directory already exists. makedirs raises on any real failure, so no
+        # re-check is needed afterwards; exist_ok tolerates another process creating it between the check and makedirs.
+        if not os.path.isdir(path):
             try:
-                os.makedirs(path)
+                os.makedirs(path, exist_ok=True)
             except OSError as e:
                 print("Error creating directory {0}: {1}: {2}.".format(path, str(e), str(e.args[0])))
                 raise
 
-        assert os.path.exists(path), "ensure_dir_in_cwd_exists: Directory {0} not found after creation.".format(path)
         return path
 
     @staticmethod
@@ -429,14 +861,24 @@ class ImgurBot:
         suffix = ImgurBot.calculate_number_of_comment_chunks(comment)
         suffix_length = len(str(suffix))
 
-        # Append each comment (with " index/total" appended to it) to the comment_list.
+        # Append each chunk (with " index/total" appended to it) to the comment_list, slicing at a moving offset so the
+        # remainder is never copied. max_len only shrinks when the index gains a digit (at 10, 100, ...).
+        total = "/" + str(suffix)
+        append = comment_list.append
+        length = len(comment)
+        position = 0
         iterations = 0
-        while len(comment) > 0:
+        next_width_change = 10
+        # Magic number explanation: 180 characters - (len(" ") + len("/")) = 178 characters
+        max_len = 178 - 1 - suffix_length
+        while position < length:
             iterations += 1
-            # Magic number explanation: 180 characters - (len(" ") + len("/")) = 178 characters
-            max_len = int((180 - len(" /")) - math.ceil(math.log10(iterations + 1)) - suffix_length)
-            comment_list.append(comment[0:max_len] + " " + str(iterations) + "/" + str(suffix))
-            comment = comment[max_len:]
+            if iterations == next_width_change:
+                max_len -= 1
+                next_width_change *= 10
+            end = position + max_len
+            append(comment[position:end] + " " + str(iterations) + total)
+            position = end
 
         # Sanity check: We're not doing something like 4/3 or 2/3
         assert iterations == suffix
@@ -449,56 +891,34 @@ class ImgurBot:
         of length <= 180. Includes calculation to allow each string to have a suffix that indicates its index and the
         total number of substrings calculated.
 
-        Accelerated pre-calculation available for strings <= 171936 characters in length. For the sake of
-        completeness, brute-force calculation is performed on strings greater than that length.
+        For a total that is suffix_length digits wide, chunks 1-9 each hold 178 - 1 - suffix_length characters, chunks
+        10-99 hold 178 - 2 - suffix_length, and so on. The count is therefore computed band by band in closed form,
+        widening the reserved total by a digit whenever the comment needs more chunks than that width can number. For
+        example, 9 chunks hold up to 1584 = 9 * (180 - len(" 1/9")) characters, 99 chunks hold up to 17235 and 999
+        chunks hold up to 171936.
 
-        Note: Explanations for pre-calculated magic numbers are provided in comments preceding the number's use.
+        Note: Explanations for magic numbers are provided in comments preceding the number's use.
         """
 
-        # Obtain the length of the comment, pre-formatted as a float to avoid truncation errors later.
-        length = float(len(comment))
-
-        # 1584 = 9 chunks * (180 characters - len(" 1/9"))
-        if length <= 1584:
-            return int(math.ceil(length / 176))
-
-        # 17235 = 9 * (180 - len(" 1/99")) + (99 - 9) * (180 - len(" 10/99"))
-        if length <= 17235:
-            # 1575 = 9 * (180 - len(" 1/99"))
-            # 174 = 180 - len(" 10/99")
-            return int(9 + math.ceil((length - 1575) / 174))
-
-        # 171936 = 9 * (180-len(" 1/999")) + (99-9) * (180-len(" 10/999")) + (999-99) * (180-len(" 100/999"))
-        if length <= 171936:
-            # 17136 = 9 * (180-len(" 1/999")) + (99-9) * (180-len(" 10/999"))
-            # 172 = 180 - len(" 100/999")
-            return int(9 + 90 + math.ceil((length - 17136) / 172))
+        length = len(comment)
 
-        # Someone's given us a string that needs to be broken up into 1000 or more substrings...
-        # Reserve 4 characters for the total and begin brute-force calculating how many substrings we'll need to hold
-        #  the entirety of the comment. If we have more than 9999 substrings required, reserve 5 characters and start
-        #  over, etc.
-
-        # TODO: This was written for the sake of completeness, but is it even desirable to have this happen?
-        # ..... maybe we should raise an exception instead.
-
-        iterations = 0
-        reserved = 4
+        suffix_length = 1
         while True:
-            iterations += 1
-
-            # Calculate the maximum allowable length for this comment chunk.
-            # Magic number explanation: 180 - (len(" ") + len("/")) = 178
-            max_len = int(178 - math.ceil(math.log10(iterations + 1)) - reserved)
-
-            # Ending case: The remaining text is less than or equal to our maximum length.
-            if length <= max_len:
-                return iterations
-
-            # Edge case: We require more space to write the count of the substrings than is reserved.
-            if math.ceil(math.log10(iterations + 1)) > reserved:
-                reserved += 1  # Increment our reservation.
-                iterations = 0
-                length = len(comment)  # Start over.
-            else:
-                length -= max_len
+            chunks = 0
+            remaining = length
+            band_size = 9  # Number of indices with index_length digits: 1-9, 10-99, 100-999, ...
+            for index_length in range(1, suffix_length + 1):
+                # Magic number explanation: 180 - (len(" ") + len("/")) = 178
+                max_len = 178 - index_length - suffix_length
+                if remaining <= band_size * max_len:
+                    # Ceiling division: the last chunk in this band may be partially filled.
+                    return chunks + -(-remaining // max_len)
+                chunks += band_size
+                remaining -= band_size * max_len
+                band_size *= 10
+
+            # Every index this total width can express is used up; reserve another digit and start over.
+            suffix_length += 1
+
+
+atexit.register(ImgurBot._close_open_bots)
@@ -1,8 +1,6 @@
 import ImgurBot
 
 name = "Example Bot"
-bot = ImgurBot.ImgurBot(name)
-
-# TODO: Write example code for bot.
-
-del bot
\ No newline at end of file
+with ImgurBot.ImgurBot(name) as bot:
+    # TODO: Write example code for bot.
+    pass
@@ -4,8 +4,16 @@ import shutil
 import sqlite3
 import string
 import random
+import time
+
+# Fixed seed so that every run fuzzes process_comment with the same strings, and failures and timings are reproducible.
+random.seed(0xC0FFEE)
 
 name = "ImgurTestBot"
+_CWD = os.getcwd()
+_ALPHABET = string.ascii_uppercase + string.digits
+# Maps every byte value onto _ALPHABET, so that a buffer of random bytes becomes a random comment in one C-level pass.
+_ALPHABET_TABLE = bytes(ord(_ALPHABET[b % len(_ALPHABET)]) for b in range(256))
 
 # TODO: Should this entire file be moved into ImgurBot as a if-main-then test?
 
@@ -13,102 +21,117 @@ name = "ImgurTestBot"
 # Directory destruction and creation methods, used in the following tests.
 def delete_dir(directory):
     """Delete the directory at os.getcwd()/directory."""
-    if os.path.exists(os.path.normpath(os.getcwd() + "/" + directory)):
-        shutil.rmtree(os.path.normpath(os.getcwd() + "/" + directory))
-    assert os.path.exists(os.path.normpath(os.getcwd() + "/" + directory)) == False
+    path = os.path.join(_CWD, directory)
+    shutil.rmtree(path, ignore_errors=True)  # Also covers the directory not existing yet.
+    assert not os.path.exists(path)
+
+
+def verify_file_in_dir(directory, file_name):
+    """Check for the existence of the directory at os.getcwd()/directory and of the file file_name inside it. A single
+    directory listing answers both, instead of a stat for each."""
+    with os.scandir(os.path.join(_CWD, directory)) as entries:  # Raises FileNotFoundError if the directory is missing.
+        assert any(entry.name == file_name and entry.is_file() for entry in entries)
 
 
-def verify_dir_exists(directory):
-    """Check for the existence of a directory at os.getcwd()/directory."""
-    assert os.path.exists(os.path.normpath(os.getcwd() + "/" + directory)) == True
+class _TestState:
+    """Progress counters shared by new_test_set and test_msg."""
+    test_set = -1  # Starts at -1 so that it becomes 0 on the first new_test_set call.
+    test_index = 1
 
 
-def verify_file_exists(my_file):
-    """Check for the existence of a file at os.getcwd()/file."""
-    assert os.path.isfile(os.path.normpath(os.getcwd() + "/" + my_file)) == True
+def random_string(length):
+    """Return a random string of the given length drawn from _ALPHABET. The bytes come from the seeded random module
+    rather than os.urandom, so that runs stay reproducible."""
+    return random.getrandbits(8 * length).to_bytes(length, 'little').translate(_ALPHABET_TABLE).decode('ascii')
 
 
 def new_test_set(message):
     """Print a message to indicate the beginning of a new test set. Message should be descriptive but concise."""
-    global test_set, test_index
-    if test_set >= 0:
-        print("\n* Successful completion of Test Set " + str(test_set + 1) + ".")
-    test_set += 1
-    test_index = 1
-    print("* Beginning Test Set " + str(test_set + 1) + ": " + message)  # Displays as 1 on first call, then 2, 3...
-test_set = -1  # Starts at -1 so that it becomes 0 on the first new_test_set call.
+    state = _TestState
+    if state.test_set >= 0:
+        print("\n* Successful completion of Test Set " + str(state.test_set + 1) + ".")
+    state.test_set += 1
+    state.test_index = 1
+    print("* Beginning Test Set " + str(state.test_set + 1) + ": " + message)  # Displays as 1 on first call, then 2...
 
 
 def test_msg(message):
     """Print a message describing the test about to be performed."""
-    global test_index, test_set
-    print("* Test case " + str(test_set + 1) + "-" + str(test_index) + ": " + message)
-    test_index += 1
-test_index = 1
+    state = _TestState
+    print("* Test case " + str(state.test_set + 1) + "-" + str(state.test_index) + ": " + message)
+    state.test_index += 1
 
 
 # Static method tests.
-# TODO: Test get_input.
-# TODO: Test get_raw_config_parser.
 # TODO: Test ensure_dir_in_cwd_exists.
 
 new_test_set("Comment processing.")
 
 # TODO: Fuzz more with random inputs.
 
+_pc = ImgurBot.ImgurBot.process_comment
+
 test_msg("Test with comments < 180 characters in length.")
 for i in range(1, 179):
-    random_comment = ''.join(random.choice(string.ascii_uppercase + string.digits) for _ in range(i))
-    for comment in ImgurBot.ImgurBot.process_comment(random_comment):
+    random_comment = random_string(i)
+    for comment in _pc(random_comment):
         assert len(comment) <= 180
         assert comment == random_comment
 
 test_msg("Test with comment == 180 characters in length.")
 # noinspection PyRedeclaration
-random_comment = ''.join(random.choice(string.ascii_uppercase + string.digits) for _ in range(180))
-for comment in ImgurBot.ImgurBot.process_comment(random_comment):
+random_comment = random_string(180)
+for comment in _pc(random_comment):
     assert len(comment) <= 180
     assert comment == random_comment
 
 test_msg("Test with comments where 181 <= length <= 500181 characters (increments of 10000).")
 for i in range(181, 500181, 10000):
     # noinspection PyRedeclaration
-    random_comment = ''.join(random.choice(string.ascii_uppercase + string.digits) for _ in range(i))
-    for comment in ImgurBot.ImgurBot.process_comment(random_comment):
-        assert len(comment) <= 180
+    random_comment = random_string(i)
+    assert max(map(len, _pc(random_comment))) <= 180
 
 # Test case setup: Initialize logging when no directories exist.
 new_test_set("Initialization of bot with no directories or files.")
-ImgurBot.ImgurBot.get_input("WARNING: This will delete all files in the ini, log, and db directories. "
-                            "Press 'enter' to proceed with the test.")
+input("WARNING: This will delete all files in the ini, log, and db directories. "
+      "Press 'enter' to proceed with the test.")
 
-delete_dir("log")
-delete_dir("db")
-delete_dir("ini")
+for directory in ("log", "db", "ini"):
+    delete_dir(directory)
 bot = ImgurBot.ImgurBot(name, print_at_log_level="Debug", testing_mode=True)
 
 test_msg("Initialize logging when no log directory exists.")
 bot.initialize_logging()
-verify_dir_exists("log")
-verify_file_exists("log/" + name + ".log")
+verify_file_in_dir("log", name + ".log")
 
 test_msg("Initialize database when no db directory exists.")
 bot.initialize_database()
-verify_dir_exists("db")
-verify_file_exists("db/" + name + ".db")
+verify_file_in_dir("db", name + ".db")
+assert bot.db.execute("PRAGMA busy_timeout").fetchone()[0] == int(ImgurBot.ImgurBot.sqlite_busy_timeout * 1000)
 
 test_msg("Initialize config when no ini directory exists.")
 bot.initialize_config()
-verify_dir_exists("ini")
-verify_file_exists("ini/" + name + ".ini")
+verify_file_in_dir("ini", name + ".ini")
+
+test_msg("Rewriting the config keeps the file's permissions and leaves no temporary file.")
+if os.name == "posix":  # Permission bits beyond read-only are POSIX-only.
+    ini_path = os.path.join(_CWD, "ini", name + ".ini")
+    assert os.stat(ini_path).st_mode & 0o777 == 0o600
+    os.chmod(ini_path, 0o640)
+    bot.write_ini_file()
+    assert os.stat(ini_path).st_mode & 0o777 == 0o640
+    assert not os.path.exists(ini_path + ".tmp")
 
 # TODO: Test client initialization.
 # test_msg("Initialize client.")
 # bot.initialize_client()
 
 new_test_set("Deletion of fully-initialized bot.")
-test_msg("Delete fully-initialized bot.")
+test_msg("Delete fully-initialized bot without closing it; the finalizer should close it and log a warning.")
+log_path = bot.logfile.name
 del bot
+with open(log_path) as log_file:
+    assert "was not closed before being garbage collected" in log_file.read()
 
 # TODO: Test for behavior with already-extant log, ini, db, etc
 
@@ -119,14 +142,18 @@ new_test_set("Database tests.")
 bot = ImgurBot.ImgurBot(name, print_at_log_level="Debug", testing_mode=True)
 bot.initialize_logging()
 bot.initialize_database()
+# The test database is thrown away between runs, so trade durability for speed (temp_store is already MEMORY).
+bot.db.execute("PRAGMA synchronous=OFF")
+bot.db.execute("PRAGMA journal_mode=MEMORY")
 
 test_msg("Adding entry to empty Seen table.")
 bot.reset_seen(True)
-bot.mark_seen("1")
-assert bot.has_seen("1") == True
-bot.mark_seen("2")
-assert bot.has_seen("2") == True
-assert bot.has_seen("0") == False
+with bot.batch_seen():
+    bot.mark_seen("1")
+    assert bot.has_seen("1")
+    bot.mark_seen("2")
+    assert bot.has_seen("2")
+assert not bot.has_seen("0")
 
 # Test case: Adding conflicting entries to Seen table.
 test_msg("Adding conflicting entry to Seen table.")
@@ -139,9 +166,151 @@ else:
     print("Test failure: mark_seen of previously seen post did not produce an error.")
     exit(1)
 
-assert bot.has_seen("1") == True
-assert bot.has_seen("0") == False
+assert bot.has_seen("1")
+assert not bot.has_seen("0")
+
+# Test case: Bulk insertion, which runs one prepared INSERT over every id in a single transaction.
+test_msg("Adding many entries, including an already-seen one, to Seen table at once.")
+bulk_ids = [str(i) for i in range(3, 1003)]
+bot.mark_seen_many(["1"] + bulk_ids)
+assert bot.has_seen_many(bulk_ids) == set(bulk_ids)
+assert not bot.has_seen_many(["0", "1003"])
+assert bot.db.execute("SELECT COUNT(*) FROM Seen").fetchone()[0] == len(bulk_ids) + 2
+
+# Test case: Insertion of ids that the Seen table cannot hold.
+test_msg("Adding invalid ids, singly or in bulk, is rejected before anything is written.")
+for invalid_ids in (["valid", None], ["valid", 1]):
+    try:
+        bot.mark_seen_many(invalid_ids)
+    except TypeError:
+        pass
+    else:
+        print("Test failure: mark_seen_many of {0!r} did not produce an error.".format(invalid_ids))
+        exit(1)
+    assert not bot.has_seen_many(invalid_ids)
+    assert not bot.db.in_transaction
+for invalid_id in (None, 1003):
+    try:
+        bot.mark_seen(invalid_id)
+    except TypeError:
+        pass
+    else:
+        print("Test failure: mark_seen of {0!r} did not produce an error.".format(invalid_id))
+        exit(1)
+    assert not bot.has_seen(invalid_id) and not bot.has_seen(str(invalid_id))
+    assert not bot.db.in_transaction
+
+# Test case: A batch_seen block that crosses seen_commit_threshold.
+test_msg("A batch_seen block stays one transaction past seen_commit_threshold.")
+ImgurBot.ImgurBot.seen_commit_threshold = 3
+with bot.batch_seen():
+    for post_id in ("batch-1", "batch-2", "batch-3", "batch-4"):
+        bot.mark_seen(post_id)
+        assert bot.db.in_transaction
+assert not bot.db.in_transaction
+ImgurBot.ImgurBot.seen_commit_threshold = 500
+
+# Test case: close() inside batch_seen, once the timed commit is already waiting on the block's lock.
+test_msg("Closing the bot inside a batch_seen block is refused rather than deadlocking.")
+ImgurBot.ImgurBot.seen_commit_interval = 0.1
+with bot.batch_seen():
+    bot.mark_seen("batch-close")
+    time.sleep(0.3)
+    try:
+        bot.close()
+    except RuntimeError:
+        pass
+    else:
+        print("Test failure: close() inside a batch_seen block did not produce an error.")
+        exit(1)
+    assert not bot.closed
+assert not bot.db.in_transaction
+
+# Test case: A failed bulk insertion, forced by a temporary trigger, must not hold the write lock open.
+test_msg("A failed bulk insertion still has its transaction committed by the timed commit.")
+bot.db.execute("CREATE TEMP TRIGGER fail_boom BEFORE INSERT ON Seen WHEN NEW.id = 'boom' "
+               "BEGIN SELECT RAISE(ABORT, 'boom'); END")
+try:
+    bot.mark_seen_many(["before-boom", "boom"])
+except sqlite3.Error:
+    pass
+else:
+    print("Test failure: mark_seen_many did not raise the trigger's error.")
+    exit(1)
+assert not bot.has_seen("before-boom")
+assert bot._seen_timer is not None
+bot._seen_timer.join()
+assert not bot.db.in_transaction
+bot.db.execute("DROP TRIGGER fail_boom")
+ImgurBot.ImgurBot.seen_commit_interval = 1.0
+
+# Test cases: Pending inserts hold SQLite's write lock, which a second connection needs, until they are committed.
+other_db = sqlite3.connect(bot.db_path, timeout=0, isolation_level=None)
+
+
+def other_db_can_write():
+    """Return whether the second connection can take the write lock right now."""
+    try:
+        other_db.execute("BEGIN IMMEDIATE")
+    except sqlite3.OperationalError:
+        return False
+    other_db.execute("ROLLBACK")
+    return True
+
+
+test_msg("A second connection can write once seen_commit_interval has elapsed.")
+ImgurBot.ImgurBot.seen_commit_interval = 0.1
+bot.mark_seen("timed")
+timer = bot._seen_timer
+assert not other_db_can_write()
+time.sleep(ImgurBot.ImgurBot.seen_commit_interval)
+timer.join()  # Already fired or about to; joined so that a slow machine cannot fail the test.
+assert other_db_can_write()
+ImgurBot.ImgurBot.seen_commit_interval = 1.0
+
+test_msg("mark_seen with commit set commits before returning.")
+bot.mark_seen("committed", commit=True)
+assert other_db_can_write()
+assert other_db.execute("SELECT COUNT(*) FROM Seen WHERE id = 'committed'").fetchone()[0] == 1
+other_db.close()
+
+test_msg("Inserts still pending at close() survive a reopen.")
+bot.mark_seen("pending-at-close")
+assert bot.db.in_transaction
+seen_before_close = set(bot.seen)
+bot.close()
+bot = ImgurBot.ImgurBot(name, print_at_log_level="Debug", testing_mode=True)
+bot.initialize_logging()
+bot.initialize_database()
+assert bot.seen == seen_before_close
+assert bot.has_seen("pending-at-close")
+bot.close()
+
+new_test_set("Migration of a Seen table created by an earlier version.")
+legacy_name = name + "Legacy"
+legacy_path = os.path.join(_CWD, "db", legacy_name + ".db")
+if os.path.exists(legacy_path):
+    os.remove(legacy_path)
+legacy_ids = set(random_string(8) for _ in range(1000))
+legacy_db = sqlite3.connect(legacy_path)
+legacy_db.execute("CREATE TABLE Seen(id TEXT PRIMARY KEY NOT NULL)")
+legacy_db.executemany("INSERT INTO Seen(id) VALUES (?)", ((post_id,) for post_id in legacy_ids))
+legacy_db.commit()
+legacy_db.close()
+
+bot = ImgurBot.ImgurBot(legacy_name, print_at_log_level="Debug", testing_mode=True)
+bot.initialize_logging()
 
-del bot
+test_msg("Initialize database on a rowid Seen table.")
+bot.initialize_database()
+schema = bot.db.execute("SELECT sql FROM sqlite_master WHERE type = 'table' AND name = 'Seen'").fetchone()[0]
+assert "WITHOUT ROWID" in schema.upper()
+assert bot.db.execute("SELECT COUNT(*) FROM sqlite_master WHERE name = 'Seen_new'").fetchone()[0] == 0
+
+test_msg("Every row survives the migration.")
+assert set(row[0] for row in bot.db.execute("SELECT id FROM Seen")) == legacy_ids
+assert bot.has_seen_many(legacy_ids) == legacy_ids
+
+bot.close()
 
-print("* Successful completion of Test Set " + str(test_set + 1) + ". All tests complete.")
+print("* Successful completion of Test Set " + str(_TestState.test_set + 1) + ". All tests complete.")